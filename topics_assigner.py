@@ -4,16 +4,39 @@ It reads input from a CSV file, processes the descriptions,
 and writes the topics to an output CSV file.
 """
 
+# pylint: disable=too-many-lines
+
 import os
+import re
 import time
+import signal
+import json
+import random
+import hashlib
+import asyncio
 import logging
 import csv
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Optional
+import diskcache
+import httpx
+import numpy as np
 import pandas as pd
 import openai
-from openai import OpenAI
+import tiktoken
+import lxml.etree
+import lxml.html
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
+
+# Prefer the much faster Lexbor-based parser, falling back to lxml if it is missing
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -24,8 +47,331 @@ load_dotenv()
 # Set your OpenAI API key
 open_ai_api = os.getenv("OPENAI_API_KEY")
 
-# Set up OpenAI API key
-client = OpenAI(api_key=open_ai_api)
+
+def create_client(max_connections):
+    """
+    Creates the async OpenAI client used for a run.
+
+    The client keeps a pool of reusable connections, one per concurrent request, and
+    does not retry by itself since `request_chat_completion` handles retries.
+
+    :param max_connections: Maximum number of open (and kept-alive) connections
+    :return: An AsyncOpenAI client, to be closed with `await client.close()`
+    """
+    return AsyncOpenAI(
+        api_key=open_ai_api,
+        max_retries=0,
+        http_client=openai.DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        ),
+    )
+
+
+# Model used for topic extraction and its response size limit
+MODEL = "gpt-4o-mini"
+MAX_TOKENS = 100
+
+# Instructions shared by every request. The allowed topics are listed by the response
+# format, so the prompt prefix is identical across requests and can be cached by the API.
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": (
+        "You classify books into topics. Based on the book's title and description, "
+        "choose between 3 and 10 of the allowed topics that best match the book. "
+        "Only pick topics that are clearly applicable, and avoid including "
+        "irrelevant ones."
+    ),
+}
+
+# Tokenizer used to estimate the token cost of each request and to truncate descriptions
+encoding = tiktoken.encoding_for_model(MODEL)
+
+# Descriptions are truncated to this many tokens, which is enough to classify a book
+MAX_DESC_TOKENS = 256
+
+# On-disk cache of API responses, so repeated prompts cost no tokens
+CACHE_DIR = ".llm_cache"
+CACHE_EXPIRE = 30 * 24 * 60 * 60  # 30 days, in seconds
+
+# Embedding cache of descriptions, so near-duplicate books reuse earlier topics
+SEMANTIC_CACHE_DIR = ".semantic_cache"
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_CACHE_SAVE_EVERY = 100  # New entries between saves to disk
+
+# Number of rows preprocessed together by a worker process
+PREPROCESS_BATCH_SIZE = 256
+
+# Number of output rows buffered between flushes to disk
+FLUSH_EVERY = 100
+
+# Input columns used to assign topics, and how many rows are read at a time
+INPUT_COLUMNS = ("id", "title", "description", "ai_description")
+CHUNK_SIZE = 10_000
+
+# Batch API limits and how often to check on a submitted batch
+BATCH_MAX_REQUESTS = 50_000
+BATCH_MAX_BYTES = 190_000_000  # Input file size, under the 200 MB limit
+BATCH_POLL_INTERVAL = 60  # seconds
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Runs of whitespace, including newlines and non-breaking spaces
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+class RateLimiter:
+    """
+    Token bucket that keeps requests under the per-minute request and token limits.
+
+    Capacity refills continuously at the configured per-minute rates, and is
+    resynchronised from the rate limit headers returned by the OpenAI API.
+    """
+
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = float(max_requests_per_minute)
+        self.available_token_capacity = float(max_tokens_per_minute)
+        self.last_update_time = time.monotonic()
+
+    def refill(self):
+        """
+        Adds the capacity accumulated since the last refill, up to the per-minute limits.
+        """
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity
+            + self.max_requests_per_minute * elapsed / 60,
+            self.max_requests_per_minute,
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60,
+            self.max_tokens_per_minute,
+        )
+        self.last_update_time = now
+
+    async def acquire(self, num_tokens):
+        """
+        Waits until there is capacity for one request of the given token cost and consumes it.
+
+        :param num_tokens: Estimated number of tokens (prompt and completion) of the request
+        """
+        # A single request can never need more than a full minute of tokens
+        num_tokens = min(num_tokens, self.max_tokens_per_minute)
+
+        self.refill()
+        while (
+            self.available_request_capacity < 1
+            or self.available_token_capacity < num_tokens
+        ):
+            await asyncio.sleep(0.05)
+            self.refill()
+
+        self.available_request_capacity -= 1
+        self.available_token_capacity -= num_tokens
+
+    def update_from_headers(self, headers):
+        """
+        Lowers the available capacity to the remaining limits reported by the API.
+
+        :param headers: The HTTP response headers of an OpenAI API call
+        """
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None:
+            self.available_request_capacity = min(
+                self.available_request_capacity, float(remaining_requests)
+            )
+
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            self.available_token_capacity = min(
+                self.available_token_capacity, float(remaining_tokens)
+            )
+
+
+class SemanticCache:
+    """
+    Cache returning the topics of a previously seen description that is nearly
+    identical to a new one, measured by the cosine similarity of their embeddings.
+
+    The FAISS index and the topics of its entries are saved to disk every
+    SEMANTIC_CACHE_SAVE_EVERY additions, and discarded when the topics list changes.
+    FAISS and sentence-transformers are only imported when the cache is created,
+    since they are optional and slow to import.
+    """
+
+    def __init__(self, cache_dir, topics_hash, threshold=0.95):
+        # pylint: disable=import-outside-toplevel
+        import faiss
+        from sentence_transformers import SentenceTransformer
+
+        self.cache_dir = cache_dir
+        self.topics_hash = topics_hash
+        self.threshold = threshold
+        self.unsaved_entries = 0
+        self.model = SentenceTransformer(EMBEDDING_MODEL)
+        self.index = faiss.IndexFlatIP(self.model.get_sentence_embedding_dimension())
+        self.entries = []
+
+        index_path = os.path.join(cache_dir, "index.faiss")
+        entries_path = os.path.join(cache_dir, "entries.json")
+        if os.path.exists(index_path) and os.path.exists(entries_path):
+            with open(entries_path, "r", encoding="utf-8") as file:
+                saved = json.load(file)
+            if saved["topics_hash"] == topics_hash:
+                self.index = faiss.read_index(index_path)
+                self.entries = saved["entries"]
+            else:
+                logging.info("Topics list changed. Discarding the semantic cache.")
+
+    async def embed(self, description):
+        """
+        Computes the normalised embedding of a description off the event loop.
+
+        :param description: The preprocessed book description
+        :return: A float32 array of shape (1, dimension)
+        """
+        loop = asyncio.get_running_loop()
+        embedding = await loop.run_in_executor(
+            None, partial(self.model.encode, [description], normalize_embeddings=True)
+        )
+        return np.asarray(embedding, dtype="float32")
+
+    def lookup(self, embedding):
+        """
+        Returns the topics of the most similar cached description, if similar enough.
+
+        :param embedding: The embedding returned by `embed`
+        :return: The cached topics list, or None on a miss
+        """
+        if self.index.ntotal == 0:
+            return None
+
+        similarities, ids = self.index.search(embedding, 1)
+        if similarities[0][0] >= self.threshold:
+            return self.entries[ids[0][0]]
+        return None
+
+    def add(self, embedding, topics_list):
+        """
+        Adds a description embedding and its topics to the cache.
+
+        :param embedding: The embedding returned by `embed`
+        :param topics_list: The topics assigned to the description
+        """
+        self.index.add(embedding)
+        self.entries.append(topics_list)
+        self.unsaved_entries += 1
+
+        if self.unsaved_entries >= SEMANTIC_CACHE_SAVE_EVERY:
+            self.save()
+
+    def save(self):
+        """
+        Writes the index and its entries to disk.
+        """
+        import faiss  # pylint: disable=import-outside-toplevel
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(self.cache_dir, "index.faiss"))
+        entries_path = os.path.join(self.cache_dir, "entries.json")
+        with open(entries_path, "w", encoding="utf-8") as file:
+            json.dump({"topics_hash": self.topics_hash, "entries": self.entries}, file)
+        self.unsaved_entries = 0
+
+
+@dataclass
+class AssignmentOptions:
+    """
+    Settings controlling how a run talks to the OpenAI API.
+
+    :param concurrency: Maximum number of concurrent API requests
+    :param max_requests_per_minute: Requests per minute allowed by the OpenAI rate limit
+    :param max_tokens_per_minute: Tokens per minute allowed by the OpenAI rate limit
+    :param semantic_cache: Whether to reuse the topics of near-duplicate descriptions
+    :param batch: Whether to use the OpenAI Batch API instead of interactive requests
+    :param workers: Number of processes cleaning the descriptions, defaults to the CPU count
+    """
+
+    concurrency: int = 8
+    max_requests_per_minute: float = 500
+    max_tokens_per_minute: float = 200_000
+    semantic_cache: bool = False
+    batch: bool = False
+    workers: Optional[int] = None
+
+
+@dataclass
+class AssignmentContext:  # pylint: disable=too-many-instance-attributes
+    """
+    Shared state used to assign topics to every book in a run.
+
+    :param client: The async OpenAI client
+    :param cache: The on-disk cache of API responses
+    :param topics_hash: Hash of the topics list, used to key the response cache
+    :param response_format: Structured output format restricting replies to the topics
+    :param response_format_tokens: Number of prompt tokens taken by the response format
+    :param rate_limiter: Rate limiter throttling the OpenAI API requests
+    :param semantic_cache: Cache of near-duplicate descriptions, if enabled
+    :param executor: Process pool preprocessing the rows
+    """
+
+    client: AsyncOpenAI
+    cache: diskcache.Cache
+    topics_hash: str
+    response_format: dict
+    response_format_tokens: int
+    rate_limiter: RateLimiter
+    semantic_cache: Optional[SemanticCache] = None
+    executor: Optional[ProcessPoolExecutor] = None
+
+
+def create_context(topics, options):
+    """
+    Creates the shared state for a run.
+
+    :param topics: List of topics to match with
+    :param options: Settings for the API requests
+    :return: An AssignmentContext, whose client and cache must be closed
+        and executor shut down at the end of the run
+    """
+    topics_hash = hashlib.sha256("\n".join(sorted(topics)).encode("utf-8")).hexdigest()
+    response_format = build_response_format(topics)
+
+    # Close the cache's connection until it is first used, by which time the worker
+    # processes have been forked, so they do not inherit an open database connection
+    cache = diskcache.Cache(CACHE_DIR)
+    cache.close()
+
+    return AssignmentContext(
+        client=create_client(options.concurrency),
+        cache=cache,
+        topics_hash=topics_hash,
+        response_format=response_format,
+        response_format_tokens=len(encoding.encode(json.dumps(response_format))),
+        rate_limiter=RateLimiter(
+            options.max_requests_per_minute, options.max_tokens_per_minute
+        ),
+        semantic_cache=(
+            SemanticCache(SEMANTIC_CACHE_DIR, topics_hash)
+            if options.semantic_cache
+            else None
+        ),
+        executor=ProcessPoolExecutor(
+            max_workers=options.workers, initializer=ignore_interrupts
+        ),
+    )
+
+
+def ignore_interrupts():
+    """
+    Makes a worker process ignore SIGINT, leaving the main process to stop the run.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
 # Function to load topics from a file
@@ -53,17 +399,17 @@ def clean_html(raw_html):
         return ""
 
     # Parse HTML and extract text
-    soup = BeautifulSoup(raw_html, "html.parser")
-    cleaned_text = soup.get_text(separator=" ", strip=True)
-
-    # Decode HTML entities like &#10; (newline) and others
-    cleaned_text = cleaned_text.replace("\n", " ").replace("\r", " ")
-
-    # Remove excessive whitespace, including encoded HTML spaces
-    cleaned_text = " ".join(cleaned_text.split())
+    if LexborHTMLParser is not None:
+        cleaned_text = LexborHTMLParser(raw_html).text(separator=" ", strip=True)
+    else:
+        try:
+            cleaned_text = " ".join(lxml.html.fromstring(raw_html).itertext())
+        except lxml.etree.ParserError:  # Raised for documents with no content
+            cleaned_text = ""
 
-    # Explicitly remove all occurrences of "\n"
-    cleaned_text = cleaned_text.replace("\\n", "").strip()
+    # Collapse newlines and excessive whitespace, including encoded HTML spaces,
+    # then explicitly remove all occurrences of "\n"
+    cleaned_text = WHITESPACE_RE.sub(" ", cleaned_text).replace("\\n", "").strip()
 
     # Return an empty string if the cleaned text is effectively empty
     if not cleaned_text:
@@ -72,50 +418,185 @@ def clean_html(raw_html):
     return cleaned_text
 
 
-# Function to get the topic list from OpenAI API
-def get_topics_for_book(description, topics):
+def get_retry_delay(error, attempt, base_delay, max_delay):
     """
-    Uses the OpenAI API to extract relevant topics based on a book description.
+    Computes how long to wait before retrying a failed OpenAI API request.
+
+    Honours the Retry-After header when the API sends one, and otherwise backs off
+    exponentially. Random jitter keeps concurrent workers from retrying in lockstep.
+
+    :param error: The exception raised by the failed request
+    :param attempt: The zero-based number of the failed attempt
+    :param base_delay: Delay in seconds before the first retry
+    :param max_delay: Upper bound in seconds for any single delay
+    :return: The delay in seconds
     """
-    prompt = (
-        f"Based on the following book description, choose the most relevant topics from the "
-        f"provided topic list. Select between 3 and 10 topics that best match the book's "
-        f"description. Make sure to only pick topics from the provided list that are "
-        f"clearly applicable, and avoid including irrelevant ones.\n\n"
-        f"Description: {description}\n\n"
-        f"Topics List: {', '.join(topics)}\n\n"
-        f"Return the chosen topics as a comma-separated list without any additional text."
+    delay = base_delay * 2**attempt
+
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after_ms = response.headers.get("retry-after-ms")
+        retry_after = response.headers.get("retry-after")
+        try:
+            if retry_after_ms is not None:
+                delay = float(retry_after_ms) / 1000
+            elif retry_after is not None:
+                delay = float(retry_after)
+        except ValueError:
+            pass  # Ignore malformed headers (e.g. HTTP dates) and keep the backoff
+
+    return min(delay + random.random() * 0.5, max_delay)
+
+
+async def request_chat_completion(
+    messages, context, max_retries=5, base_delay=1.0, max_delay=60.0
+):
+    """
+    Sends a chat completion request, retrying rate limit and transient errors.
+
+    :param messages: The chat messages to send
+    :param context: Shared state providing the client and rate limiter
+    :param max_retries: Maximum number of attempts
+    :param base_delay: Delay in seconds before the first retry
+    :param max_delay: Upper bound in seconds for any single retry delay
+    :return: The chat completion, or None if every attempt failed
+    """
+    num_tokens = (
+        sum(len(encoding.encode(message["content"])) for message in messages)
+        + context.response_format_tokens
+        + MAX_TOKENS
     )
-    delay = 2  # Initial delay in seconds
 
-    for attempt in range(5):
+    for attempt in range(max_retries):
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": prompt},
-                ],
-                max_tokens=100,
+            await context.rate_limiter.acquire(num_tokens)
+            raw_response = await context.client.chat.completions.with_raw_response.create(
+                model=MODEL,
+                messages=messages,
+                max_tokens=MAX_TOKENS,
+                response_format=context.response_format,
             )
-
-            # Convert the comma-separated response to a list
-            return [
-                topic.strip()
-                for topic in response.choices[0].message.content.split(",")
-                if topic.strip() in topics
-            ]
-        except openai.RateLimitError:
-            delay = min(60, 2 * (attempt + 1))
-            logging.warning("Rate limit exceeded. Retrying in %s seconds.", delay)
-            time.sleep(delay)
+            context.rate_limiter.update_from_headers(raw_response.headers)
+            return raw_response.parse()
+        except (
+            openai.RateLimitError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
+        ) as e:
+            if attempt == max_retries - 1:
+                break
+            delay = get_retry_delay(e, attempt, base_delay, max_delay)
+            logging.warning("%s. Retrying in %.1f seconds.", type(e).__name__, delay)
+            await asyncio.sleep(delay)
         except openai.OpenAIError as e:
             logging.error("OpenAI API error: %s", e)
-            break
+            return None
+
+    logging.error("Failed to retrieve topics after %s attempts.", max_retries)
+    return None
+
+
+def get_cache_key(messages, topics_hash):
+    """
+    Builds the response cache key for a request.
+
+    :param messages: The chat messages of the request
+    :param topics_hash: Hash of the topics list, so editing the topics invalidates entries
+    :return: A hex digest identifying the request
+    """
+    payload = json.dumps([MODEL, messages, topics_hash])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def build_response_format(topics):
+    """
+    Builds the structured output format of the replies.
+
+    The model must reply with a JSON object whose topics are taken from the topics list,
+    so replies never contain unknown or reformatted topics.
+
+    :param topics: List of topics to choose from
+    :return: The `response_format` argument of the chat completion requests
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "book_topics",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "topics": {
+                        "type": "array",
+                        "minItems": 3,
+                        "maxItems": 10,
+                        "items": {"type": "string", "enum": topics},
+                    }
+                },
+                "required": ["topics"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def build_messages(description):
+    """
+    Builds the chat messages asking the model to pick topics for a book description.
+
+    :param description: The preprocessed book description
+    :return: The list of chat messages
+    """
+    return [
+        SYSTEM_MESSAGE,
+        {"role": "user", "content": f"Title and description: {description}"},
+    ]
+
+
+def parse_topics(response_text):
+    """
+    Extracts the list of topics from the model's JSON reply.
+
+    :param response_text: The content of the model's reply, None if the model refused
+    :return: The topics without duplicates, or None if the reply is not valid
+    """
+    try:
+        return list(dict.fromkeys(json.loads(response_text)["topics"]))
+    except (TypeError, ValueError, KeyError):
+        logging.error("Invalid response from the model: %s", response_text)
+        return None
 
-    # If all attempts fail
-    logging.error("Failed to retrieve topics after multiple attempts.")
-    return []
+
+# Function to get the topic list from OpenAI API
+async def get_topics_for_book(description, context):
+    """
+    Uses the OpenAI API to extract relevant topics based on a book description.
+    """
+    messages = build_messages(description)
+
+    cache_key = get_cache_key(messages, context.topics_hash)
+    cached_topics = context.cache.get(cache_key)
+    if cached_topics is not None:
+        return cached_topics
+
+    if context.semantic_cache:
+        embedding = await context.semantic_cache.embed(description)
+        cached_topics = context.semantic_cache.lookup(embedding)
+        if cached_topics is not None:
+            return cached_topics
+
+    response = await request_chat_completion(messages, context)
+    if response is None:
+        return []
+
+    topics_list = parse_topics(response.choices[0].message.content)
+    if topics_list is None:
+        return []
+
+    context.cache.set(cache_key, topics_list, expire=CACHE_EXPIRE)
+    if context.semantic_cache and topics_list:
+        context.semantic_cache.add(embedding, topics_list)
+    return topics_list
 
 
 # Validate and preprocess descriptions
@@ -139,25 +620,78 @@ def preprocess_description(ai_description, description, title):
         logging.warning("No valid description found for title '%s'", title)
         return ""
 
-    # Truncate the description if it's too long (let's say we limit it to 1000 characters)
-    max_desc_length = 1000
-    return f"{title}: {combined_description[:max_desc_length]}"
+    # Truncate the description by tokens, so every prompt costs about the same
+    tokens = encoding.encode(combined_description)
+    if len(tokens) > MAX_DESC_TOKENS:
+        combined_description = encoding.decode(tokens[:MAX_DESC_TOKENS])
+    return f"{title}: {combined_description}"
+
+
+def remove_incomplete_last_row(output_file):
+    """
+    Truncates a partially written last row from the output file.
+
+    Rows are flushed to disk in batches, so a killed run can leave the file ending
+    mid-row. Removing it lets the run resume from the last complete row.
+
+    :param output_file: Path to the output CSV file
+    """
+    if not os.path.exists(output_file):
+        return
+
+    with open(output_file, mode="rb+") as output_csv:
+        end = output_csv.seek(0, os.SEEK_END)
+        if end == 0:
+            return
+        output_csv.seek(end - 1)
+        if output_csv.read(1) == b"\n":
+            return
+
+        # Search backwards for the end of the last complete row
+        while end > 0:
+            start = max(0, end - 4096)
+            output_csv.seek(start)
+            newline = output_csv.read(end - start).rfind(b"\n")
+            if newline != -1:
+                break
+            end = start
+        output_csv.truncate(start + newline + 1 if end > 0 else 0)
+
+    logging.warning("Removed an incomplete last row from %s.", output_file)
 
 
 def get_last_processed_id(output_file):
     """
     Retrieves the last processed ID from the output file to enable resuming.
 
+    Only the end of the file is read, so this takes the same time however large the
+    output file has grown.
+
     :param output_file: Path to the output CSV file
     :return: The ID of the last processed row, or None if the file` is empty
     """
-    if os.path.exists(output_file):
-        with open(output_file, mode="r", encoding="utf-8") as output_csv:
-            reader = csv.DictReader(output_csv)
-            rows = list(reader)
-            if rows:
-                return rows[-1]["id"]
-    return None
+    if not os.path.exists(output_file):
+        return None
+
+    with open(output_file, mode="rb") as output_csv:
+        file_size = output_csv.seek(0, os.SEEK_END)
+        tail_size = 4096
+
+        # Read a larger tail until it holds the whole last line
+        while True:
+            start = max(0, file_size - tail_size)
+            output_csv.seek(start)
+            tail = output_csv.read().decode("utf-8", errors="ignore")
+            lines = [line for line in tail.splitlines() if line.strip()]
+            if start == 0 or len(lines) > 1:
+                break
+            tail_size *= 2
+
+    # The first line of the file is the header
+    if start == 0 and len(lines) <= 1:
+        return None
+
+    return next(csv.reader([lines[-1]]))[0]
 
 
 def resume_from_last_processed(df, last_processed_id):
@@ -166,45 +700,597 @@ def resume_from_last_processed(df, last_processed_id):
 
     :param df: The original dataframe
     :param last_processed_id: The last processed ID from the output file
-    :return: A filtered dataframe starting from the next row
+    :return: A filtered dataframe starting from the next row,
+        or None if the dataframe does not contain the ID
     """
-    try:
-        start_index = df[df["id"] == last_processed_id].index[0] + 1
-        return df.iloc[start_index:]
-    except IndexError:
-        logging.warning(
-            "Could not find last processed ID in input file. Processing all rows."
-        )
-        return df
+    positions = (df["id"] == last_processed_id).to_numpy().nonzero()[0]
+    if len(positions) == 0:
+        return None
+    return df.iloc[positions[0] + 1 :]
 
 
-def process_and_write_row(row, topics, writer, output_csv):
+def read_input_chunks(input_file, chunk_size):
     """
-    Processes a single row and writes the result to the output CSV.
+    Reads the input CSV lazily, a chunk of rows at a time.
 
-    :param row: The dataframe row representing a book
-    :param topics: List of topics to match with
-    :param writer: The CSV DictWriter object to write the result
+    Only the columns used to assign topics are parsed, and IDs are kept as strings so
+    they compare equal to the IDs read back from the output file.
+
+    :param input_file: Path to the input CSV file containing book descriptions
+    :param chunk_size: Number of rows per chunk
+    :return: An iterator of dataframes
+    """
+    return pd.read_csv(
+        input_file,
+        chunksize=chunk_size,
+        dtype={"id": str},
+        usecols=lambda column: column in INPUT_COLUMNS,
+    )
+
+
+def read_unprocessed_chunks(input_file, last_processed_id, chunk_size):
+    """
+    Reads the input CSV in chunks, starting from the row after the last processed ID.
+
+    :param input_file: Path to the input CSV file containing book descriptions
+    :param last_processed_id: The last processed ID from the output file, if any
+    :param chunk_size: Number of rows per chunk
+    :return: An iterator of dataframes
+    """
+    chunks = read_input_chunks(input_file, chunk_size)
+
+    if last_processed_id:
+        for chunk in chunks:
+            remaining_rows = resume_from_last_processed(chunk, last_processed_id)
+            if remaining_rows is not None:
+                logging.info("Resuming from last processed ID: %s", last_processed_id)
+                yield remaining_rows
+                break
+        else:
+            logging.warning(
+                "Could not find last processed ID in input file. Processing all rows."
+            )
+            chunks = read_input_chunks(input_file, chunk_size)
+
+    yield from chunks
+
+
+def iter_rows(df):
+    """
+    Iterates over the rows of the dataframe as plain tuples.
+
+    This avoids building a pandas Series for every row, as `df.iterrows()` does.
+    Missing titles are filled with an empty string, and other optional columns
+    missing from the input with NaN.
+
+    :param df: The dataframe of books
+    :return: An iterator of (id, title, description, ai_description) tuples
+    """
+    df = df.reindex(columns=INPUT_COLUMNS).fillna({"title": ""})
+    return df.itertuples(index=False, name=None)
+
+
+def prepare_row(row):
+    """
+    Extracts the book ID and the preprocessed description from a row.
+
+    :param row: The (id, title, description, ai_description) tuple representing a book
+    :return: A tuple of the book ID and its description, empty if the row must be skipped
     """
-    book_id = row["id"]
-    title = row.get("title", "")
-    description = row.get("description", "")
-    ai_description = row.get("ai_description", "")
+    book_id, title, description, ai_description = row
 
-    logging.info("Processing ID %s", book_id)
     combined_description = preprocess_description(ai_description, description, title)
 
     if not combined_description:
         logging.warning("Skipping ID %s due to empty description.", book_id)
-        return
 
-    topics_list = get_topics_for_book(combined_description, topics)
-    writer.writerow({"id": book_id, "topics_list": str(topics_list)})
+    return book_id, combined_description
+
+
+def prepare_rows(rows):
+    """
+    Extracts the book IDs and preprocessed descriptions from a list of rows.
+
+    Runs in a worker process, so that cleaning descriptions does not hold up the
+    event loop dispatching API requests.
+
+    :param rows: List of (id, title, description, ai_description) tuples
+    :return: List of (book ID, description) tuples, see `prepare_row`
+    """
+    return [prepare_row(row) for row in rows]
+
+
+def schedule_preprocessing(df, executor):
+    """
+    Starts preprocessing the dataframe rows in worker processes,
+    PREPROCESS_BATCH_SIZE rows at a time.
+
+    :param df: The dataframe of books to process
+    :param executor: The process pool preprocessing the rows
+    :return: List of futures of the preprocessed batches of rows, see `prepare_rows`
+    """
+    loop = asyncio.get_running_loop()
+    rows = list(iter_rows(df))
+    return [
+        loop.run_in_executor(
+            executor, prepare_rows, rows[start : start + PREPROCESS_BATCH_SIZE]
+        )
+        for start in range(0, len(rows), PREPROCESS_BATCH_SIZE)
+    ]
+
+
+async def request_topics(book_id, description, context, semaphore):
+    """
+    Gets the topics of a book, limiting the number of in-flight API requests.
+
+    :param book_id: The ID of the book
+    :param description: The preprocessed book description
+    :param context: Shared state used to assign the topics
+    :param semaphore: Semaphore bounding the number of concurrent API requests
+    :return: The list of topics
+    """
+    async with semaphore:
+        logging.info("Processing ID %s", book_id)
+        return await get_topics_for_book(description, context)
+
+
+async def process_row(prepared_batches, position, context, semaphore, requests):
+    """
+    Processes a single row.
+
+    Books with the same description as an earlier book in the chunk (such as other
+    editions of the same book) reuse its request instead of making their own.
+
+    :param prepared_batches: Futures of the preprocessed batches of rows
+    :param position: Position of the row in the dataframe
+    :param context: Shared state used to assign the topics
+    :param semaphore: Semaphore bounding the number of concurrent API requests
+    :param requests: Dict mapping the descriptions of the chunk to their request tasks
+    :return: The position of the row and a tuple of the book ID and its topics,
+        or None for the topics if skipped
+    """
+    batch_index, index = divmod(position, PREPROCESS_BATCH_SIZE)
+    book_id, combined_description = (await prepared_batches[batch_index])[index]
+
+    if not combined_description:
+        return position, (book_id, None)
+
+    request = requests.get(combined_description)
+    if request is None:
+        request = asyncio.ensure_future(
+            request_topics(book_id, combined_description, context, semaphore)
+        )
+        requests[combined_description] = request
+    else:
+        logging.info("Reusing the topics of an identical description for ID %s", book_id)
+
+    # Shielded, so cancelling one of the rows sharing the request does not cancel it
+    return position, (book_id, await asyncio.shield(request))
+
+
+def format_topics(topics_list):
+    """
+    Encodes a list of topics for the output CSV as a compact JSON array.
+
+    :param topics_list: The list of topics
+    :return: The JSON string, e.g. '["Found Family","Enemies to Lovers"]'
+    """
+    return json.dumps(topics_list, ensure_ascii=False, separators=(",", ":"))
+
+
+def write_completed_rows(completed, next_position, writer):
+    """
+    Writes the contiguous run of finished rows starting from the next row to write.
+
+    :param completed: Dict mapping the positions of finished rows to their results,
+        from which the written rows are removed
+    :param next_position: Position of the next row to write
+    :param writer: The CSV DictWriter object to write the results
+    :return: The position of the next row to write, and the number of rows written
+    """
+    rows_written = 0
+
+    while next_position in completed:
+        book_id, topics_list = completed.pop(next_position)
+        if topics_list is not None:
+            writer.writerow({"id": book_id, "topics_list": format_topics(topics_list)})
+            rows_written += 1
+        next_position += 1
+
+    return next_position, rows_written
+
+
+async def process_rows(df, context, writer, output_csv, concurrency):
+    """
+    Processes the dataframe rows concurrently and writes the results to the output CSV.
+
+    Rows are preprocessed in worker processes, and each row's request starts as soon
+    as its batch of rows is ready.
+
+    Results are written in input order as soon as every preceding row has finished,
+    so the last row in the output file is always a safe point to resume from.
+
+    :param df: The dataframe of books to process
+    :param context: Shared state used to assign the topics
+    :param writer: The CSV DictWriter object to write the results
+    :param output_csv: The open output file, flushed every FLUSH_EVERY rows
+    :param concurrency: Maximum number of concurrent API requests
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    prepared_batches = schedule_preprocessing(df, context.executor)
+    requests = {}
+    completed = {}
+    next_position = 0
+    rows_since_flush = 0
+
+    # Schedule the tasks in input order, so rows are requested (and written) in order
+    for future in asyncio.as_completed(
+        [
+            asyncio.ensure_future(
+                process_row(prepared_batches, position, context, semaphore, requests)
+            )
+            for position in range(len(df))
+        ]
+    ):
+        position, result = await future
+        completed[position] = result
+
+        next_position, rows_written = write_completed_rows(
+            completed, next_position, writer
+        )
+        rows_since_flush += rows_written
+
+        if rows_since_flush >= FLUSH_EVERY:
+            output_csv.flush()
+            rows_since_flush = 0
+
+    output_csv.flush()
+
+
+def get_batch_key(requests):
+    """
+    Builds the response cache key under which the IDs of the batches of requests
+    are stored.
+
+    :param requests: Dict mapping each request's custom ID to its chat messages
+    :return: The cache key, the same for the same set of requests
+    """
+    request_ids = "\n".join(sorted(requests)).encode("utf-8")
+    return f"batch:{hashlib.sha256(request_ids).hexdigest()}"
+
+
+async def request_with_retries(request, max_retries=5, base_delay=1.0, max_delay=60.0):
+    """
+    Sends a Batch API request, retrying rate limit and transient errors.
+
+    :param request: Function sending the request, called again for every attempt
+    :param max_retries: Maximum number of attempts
+    :param base_delay: Delay in seconds before the first retry
+    :param max_delay: Upper bound in seconds for any single retry delay
+    :return: The result of the request
+    :raises openai.OpenAIError: If the last attempt fails, or on any other error
+    """
+    for attempt in range(max_retries - 1):
+        try:
+            return await request()
+        except (
+            openai.RateLimitError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
+        ) as e:
+            delay = get_retry_delay(e, attempt, base_delay, max_delay)
+            logging.warning("%s. Retrying in %.1f seconds.", type(e).__name__, delay)
+            await asyncio.sleep(delay)
+
+    return await request()
+
+
+def build_batch_inputs(context, requests):
+    """
+    Builds the JSONL input files of the batches of chat completion requests.
+
+    Every line repeats the response format, so large topics lists make for large
+    files. Requests are split between as many files as needed to keep each one
+    under BATCH_MAX_BYTES.
+
+    :param context: Shared state providing the response format
+    :param requests: Dict mapping each request's custom ID to its chat messages
+    :return: A list of the contents of the input files
+    """
+    batch_inputs = []
+    lines = []
+    size = 0
+
+    for custom_id, messages in requests.items():
+        line = (
+            json.dumps(
+                {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": MODEL,
+                        "messages": messages,
+                        "max_tokens": MAX_TOKENS,
+                        "response_format": context.response_format,
+                    },
+                }
+            )
+            + "\n"
+        ).encode("utf-8")
+
+        if lines and size + len(line) > BATCH_MAX_BYTES:
+            batch_inputs.append(b"".join(lines))
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line)
+
+    if lines:
+        batch_inputs.append(b"".join(lines))
+    return batch_inputs
+
+
+async def create_batch(context, batch_input):
+    """
+    Uploads a batch input file and submits it to the OpenAI Batch API.
+
+    :param context: Shared state providing the client
+    :param batch_input: The contents of the input file, as built by `build_batch_inputs`
+    :return: The submitted batch
+    """
+    batch_input_file = await request_with_retries(
+        partial(
+            context.client.files.create,
+            file=("batch_input.jsonl", batch_input),
+            purpose="batch",
+        )
+    )
+    batch = await request_with_retries(
+        partial(
+            context.client.batches.create,
+            input_file_id=batch_input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+    )
+    logging.info(
+        "Submitted batch %s with %s requests.", batch.id, batch_input.count(b"\n")
+    )
+    return batch
+
+
+async def resume_or_create_batch(context, batch_id, batch_input):
+    """
+    Retrieves a previously submitted batch, or submits its input again if the batch
+    is unknown, failed, expired or was cancelled.
+
+    :param context: Shared state providing the client
+    :param batch_id: The ID of the previously submitted batch, or None
+    :param batch_input: The contents of the batch's input file
+    :return: The batch
+    """
+    if batch_id is not None:
+        try:
+            batch = await request_with_retries(
+                partial(context.client.batches.retrieve, batch_id)
+            )
+            logging.info("Resuming batch %s, which is %s.", batch.id, batch.status)
+            if batch.status not in ("failed", "expired", "cancelled"):
+                return batch
+        except openai.NotFoundError:
+            logging.warning("Batch %s was not found.", batch_id)
+
+    return await create_batch(context, batch_input)
+
+
+async def submit_batches(context, requests):
+    """
+    Submits chat completion requests to the OpenAI Batch API and waits for the batches.
+
+    The batch IDs are kept in the response cache until their results are written, so
+    that an interrupted run is resumed by waiting for the same batches instead of
+    submitting and paying for the requests again. Failed, expired and cancelled
+    batches are submitted again.
+
+    :param context: Shared state providing the client, cache and response format
+    :param requests: Dict mapping each request's custom ID to its chat messages
+    :return: The list of batches, once each has completed, failed, expired or been
+        cancelled
+    """
+    batch_key = get_batch_key(requests)
+    batch_inputs = build_batch_inputs(context, requests)
+
+    # Requests are split the same way on every run, so stored IDs match their inputs
+    batch_ids = context.cache.get(batch_key)
+    if batch_ids is None or len(batch_ids) != len(batch_inputs):
+        batch_ids = [None] * len(batch_inputs)
+
+    batches = []
+    for batch_id, batch_input in zip(batch_ids, batch_inputs):
+        batches.append(await resume_or_create_batch(context, batch_id, batch_input))
+        context.cache.set(
+            batch_key,
+            [batch.id for batch in batches] + batch_ids[len(batches) :],
+            expire=CACHE_EXPIRE,
+        )
+
+    while any(batch.status not in BATCH_FINAL_STATUSES for batch in batches):
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        for position, batch in enumerate(batches):
+            if batch.status in BATCH_FINAL_STATUSES:
+                continue
+            batches[position] = await request_with_retries(
+                partial(context.client.batches.retrieve, batch.id)
+            )
+            logging.info("Batch %s is %s.", batch.id, batches[position].status)
+
+    return batches
+
+
+async def download_batch_results(client, batches):
+    """
+    Downloads the replies and errors of the requests of completed batches.
+
+    Successful requests are listed in each batch's output file, and requests the
+    Batch API rejected or that failed in its error file.
+
+    :param client: The async OpenAI client
+    :param batches: The completed batches
+    :return: A tuple of the dict mapping each successful request's custom ID to the
+        model's reply, and of the dict mapping each failed request's custom ID to its error
+    """
+    replies = {}
+    errors = {}
+
+    file_ids = [
+        file_id
+        for batch in batches
+        for file_id in (batch.output_file_id, batch.error_file_id)
+        if file_id
+    ]
+    for file_id in file_ids:
+        batch_output = await request_with_retries(
+            partial(client.files.content, file_id)
+        )
+        for line in batch_output.text.splitlines():
+            result = json.loads(line)
+            custom_id = result["custom_id"]
+            response = result.get("response") or {}
+            if response.get("status_code") == 200:
+                message = response["body"]["choices"][0]["message"]
+                replies[custom_id] = message["content"]
+            else:
+                errors[custom_id] = result.get("error") or response.get("body")
+
+    return replies, errors
+
+
+def collect_batch_requests(df, context):
+    """
+    Builds the requests for the rows whose topics are not in the response cache.
+
+    :param df: The dataframe of books to process
+    :param context: Shared state used to assign the topics
+    :return: A tuple of the (book ID, cache key) pairs of the rows in input order,
+        the dict of chat messages to request by cache key,
+        and the dict of cached topics by cache key
+    """
+    rows = []
+    requests = {}
+    topics_by_key = {}
+
+    for book_id, combined_description in context.executor.map(
+        prepare_row, iter_rows(df), chunksize=PREPROCESS_BATCH_SIZE
+    ):
+        if not combined_description:
+            continue
+
+        messages = build_messages(combined_description)
+        cache_key = get_cache_key(messages, context.topics_hash)
+        rows.append((book_id, cache_key))
+
+        cached_topics = context.cache.get(cache_key)
+        if cached_topics is not None:
+            topics_by_key[cache_key] = cached_topics
+        else:
+            requests[cache_key] = messages
+
+    return rows, requests, topics_by_key
+
+
+async def run_batches(context, requests):
+    """
+    Runs chat completion requests through the OpenAI Batch API.
+
+    :param context: Shared state used to assign the topics
+    :param requests: Dict mapping each request's custom ID to its chat messages
+    :return: A tuple of the replies and errors by custom ID, as returned by
+        `download_batch_results`, or None if a batch did not complete
+        or the Batch API could not be reached
+    """
+    try:
+        batches = await submit_batches(context, requests)
+        incomplete_batches = [batch for batch in batches if batch.status != "completed"]
+        for batch in incomplete_batches:
+            logging.error("Batch %s %s.", batch.id, batch.status)
+        if incomplete_batches:
+            return None
+
+        return await download_batch_results(context.client, batches)
+    except openai.OpenAIError as e:
+        logging.error("OpenAI API error: %s", e)
+        return None
+
+
+async def process_rows_with_batch_api(df, context, writer, output_csv):
+    """
+    Assigns topics to the dataframe rows through the OpenAI Batch API, which costs half
+    as much as interactive requests, and writes the results to the output CSV.
+
+    Requests are keyed by their response cache key, so cached and duplicate prompts
+    are only sent once. Nothing is written unless every batch completes. When the
+    script is run again, it resumes waiting for interrupted batches, and resubmits
+    failed ones.
+
+    :param df: The dataframe of books to process
+    :param context: Shared state used to assign the topics
+    :param writer: The CSV DictWriter object to write the results
+    :param output_csv: The open output file, flushed after writing
+    :return: True if the results were written, False if a batch did not complete
+        or the Batch API could not be reached
+    """
+    rows, requests, topics_by_key = collect_batch_requests(df, context)
+    errors = {}
+
+    if requests:
+        results = await run_batches(context, requests)
+        if results is None:
+            logging.error("No results were written.")
+            return False
+        replies, errors = results
+
+        for cache_key, response_text in replies.items():
+            topics_list = parse_topics(response_text)
+            if topics_list is None:
+                continue
+            context.cache.set(cache_key, topics_list, expire=CACHE_EXPIRE)
+            topics_by_key[cache_key] = topics_list
+        context.cache.delete(get_batch_key(requests))
+
+    for book_id, cache_key in rows:
+        topics_list = topics_by_key.get(cache_key)
+        if topics_list is None:
+            # Failed requests and invalid replies are written without topics
+            logging.error(
+                "No topics returned for ID %s: %s",
+                book_id,
+                errors.get(cache_key, "no valid reply"),
+            )
+            topics_list = []
+        writer.writerow({"id": book_id, "topics_list": format_topics(topics_list)})
     output_csv.flush()
 
+    return True
+
+
+def cancel_on_signals():
+    """
+    Cancels the current task on SIGINT or SIGTERM, so that the run stops cleanly and
+    the buffered results are written to the output file.
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, task.cancel)
+        except NotImplementedError:  # Not supported on Windows
+            pass
+
 
 # Main function to process the input CSV and generate topics
-def assign_topics(input_file, output_file, topics_file):
+async def assign_topics(input_file, output_file, topics_file, options=None):
     """
     Processes the input CSV, assigns topics to books using OpenAI API,
     and writes the results to the output CSV.
@@ -212,22 +1298,28 @@ def assign_topics(input_file, output_file, topics_file):
     :param input_file: Path to the input CSV file containing book descriptions
     :param output_file: Path to the output CSV file where the results will be saved
     :param topics_file: Path to the file containing the list of topics
+    :param options: Settings for the API requests, defaults to `AssignmentOptions()`
     """
+    options = options or AssignmentOptions()
+
     # Load the topics from the provided file
     topics = load_topics_from_file(topics_file)
     if not topics:
         logging.error("No topics loaded. Exiting.")
         return
 
-    df = pd.read_csv(input_file)
-
     # Check if the output file already exists
+    remove_incomplete_last_row(output_file)
     last_processed_id = get_last_processed_id(output_file)
 
-    # Filter dataframe to start from the next unprocessed row
-    if last_processed_id:
-        df = resume_from_last_processed(df, last_processed_id)
-        logging.info("Resuming from last processed ID: %s", last_processed_id)
+    # Batches are submitted one chunk at a time, so make them as large as allowed
+    chunks = read_unprocessed_chunks(
+        input_file,
+        last_processed_id,
+        BATCH_MAX_REQUESTS if options.batch else CHUNK_SIZE,
+    )
+
+    context = create_context(topics, options)
 
     with open(output_file, mode="a", newline="", encoding="utf-8") as output_csv:
         writer = csv.DictWriter(output_csv, fieldnames=["id", "topics_list"])
@@ -236,8 +1328,28 @@ def assign_topics(input_file, output_file, topics_file):
         if output_csv.tell() == 0:
             writer.writeheader()
 
-        for _, row in df.iterrows():
-            process_and_write_row(row, topics, writer, output_csv)
+        cancel_on_signals()
+
+        try:
+            for chunk in chunks:
+                if options.batch:
+                    if not await process_rows_with_batch_api(
+                        chunk, context, writer, output_csv
+                    ):
+                        break
+                else:
+                    await process_rows(
+                        chunk, context, writer, output_csv, options.concurrency
+                    )
+        except asyncio.CancelledError:
+            logging.warning("Interrupted. Run the script again to resume.")
+            return
+        finally:
+            await context.client.close()
+            context.cache.close()
+            context.executor.shutdown()
+            if context.semantic_cache:
+                context.semantic_cache.save()
 
     logging.info("Processing completed. Results saved to %s", output_file)
 
@@ -256,8 +1368,55 @@ if __name__ == "__main__":
     parser.add_argument(
         "topics_file", help="Path to the text file containing the list of topics"
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of concurrent OpenAI API requests (default: 8)",
+    )
+    parser.add_argument(
+        "--max-requests-per-minute",
+        type=float,
+        default=500,
+        help="Requests per minute allowed by your OpenAI rate limit (default: 500)",
+    )
+    parser.add_argument(
+        "--max-tokens-per-minute",
+        type=float,
+        default=200_000,
+        help="Tokens per minute allowed by your OpenAI rate limit (default: 200000)",
+    )
+    parser.add_argument(
+        "--semantic-cache",
+        action="store_true",
+        help="Reuse the topics of near-duplicate descriptions via embedding similarity",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Use the OpenAI Batch API: half the cost, results within 24 hours",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes cleaning the descriptions (default: CPU count)",
+    )
 
     args = parser.parse_args()
 
     # Call the main function with parsed arguments
-    assign_topics(args.input_file, args.output_file, args.topics_file)
+    asyncio.run(
+        assign_topics(
+            args.input_file,
+            args.output_file,
+            args.topics_file,
+            AssignmentOptions(
+                concurrency=args.concurrency,
+                max_requests_per_minute=args.max_requests_per_minute,
+                max_tokens_per_minute=args.max_tokens_per_minute,
+                semantic_cache=args.semantic_cache,
+                batch=args.batch,
+                workers=args.workers,
+            ),
+        )
+    )